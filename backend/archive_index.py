@@ -0,0 +1,440 @@
+from fastapi import FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Any, List, Optional
+from probes import UNREADABLE_MARKER, DECK_LEVEL_FIELDS, default_fields, select_probes, needs_image
+
+# watchdog gives us inotify (or the platform equivalent); without it we only poll
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+# Resident index of the archive roots listed in ARCHIVE_ROOTS (separated by os.pathsep).
+# Every deck (a folder directly under a root) is scanned once at startup and kept current by
+# a filesystem watcher. inotify does not fire for changes made on another machine of a network
+# mount, so directory mtimes are also polled every ARCHIVE_INDEX_POLL_SECONDS. Without a watcher,
+# the size and mtime of every indexed file are polled as well to catch files changed in place.
+ARCHIVE_ROOTS = [p for p in os.environ.get("ARCHIVE_ROOTS", "").split(os.pathsep) if p.strip()]
+ARCHIVE_INDEX_MAX_FILES = int(os.environ.get("ARCHIVE_INDEX_MAX_FILES", "500000"))
+ARCHIVE_INDEX_POLL_SECONDS = float(os.environ.get("ARCHIVE_INDEX_POLL_SECONDS", "60"))
+# Bursts of events (a deck being copied in) are collected for this long before rescanning
+ARCHIVE_INDEX_DEBOUNCE_SECONDS = float(os.environ.get("ARCHIVE_INDEX_DEBOUNCE_SECONDS", "2"))
+
+class ArchiveIndexRefreshRequest(BaseModel):
+    path: Optional[str] = None  # Deck (or any folder inside it) to rescan; all decks when omitted
+
+
+def find_subtree(folder_data: Dict[str, Any], target_path: str) -> Optional[Dict[str, Any]]:
+    """Find the node for target_path inside an already scanned folder structure"""
+    if os.path.normpath(folder_data.get("path", "")) == target_path:
+        return folder_data
+    for subfolder in folder_data.get("subfolders", []):
+        subfolder_path = os.path.normpath(subfolder.get("path", ""))
+        if target_path == subfolder_path or target_path.startswith(subfolder_path + os.sep):
+            return find_subtree(subfolder, target_path)
+    return None
+
+
+def _count_files(folder_data: Dict[str, Any]) -> int:
+    return len(folder_data.get("files", [])) + sum(_count_files(s) for s in folder_data.get("subfolders", []))
+
+
+def _file_stats(folder_data: Dict[str, Any], stats: Dict[str, Any]) -> Dict[str, Any]:
+    """(size, mtime_ns) of every file in a scanned tree; catches in-place changes that leave directory mtimes alone"""
+    for file_info in folder_data.get("files", []):
+        file_path = os.path.join(folder_data["path"], file_info["name"])
+        stats[file_path] = _stat_file(file_path)
+    for subfolder in folder_data.get("subfolders", []):
+        _file_stats(subfolder, stats)
+    return stats
+
+
+def _stat_file(file_path: str):
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime_ns)
+
+
+def _project_indexed(folder_data: Dict[str, Any], fields: List[str], include_unreadable: bool) -> Dict[str, Any]:
+    """
+    Copy of an indexed tree reduced to fields. Files PIL could not open are only included for
+    listings without image fields, exactly like a direct scan, and totalImages is recounted to match.
+    """
+    projected = {key: value for key, value in folder_data.items() if key not in ("files", "subfolders", "totalImages")}
+    projected["files"] = [
+        {key: value for key, value in file_info.items() if key in fields}
+        for file_info in folder_data.get("files", [])
+        if include_unreadable or UNREADABLE_MARKER not in file_info
+    ]
+    projected["subfolders"] = [
+        _project_indexed(subfolder, fields, include_unreadable) for subfolder in folder_data.get("subfolders", [])
+    ]
+    projected["totalImages"] = len(projected["files"]) + sum(s["totalImages"] for s in projected["subfolders"])
+    return projected
+
+
+def _directory_mtimes(folder_data: Dict[str, Any], mtimes: Dict[str, int]) -> Dict[str, int]:
+    """mtime of every directory in a scanned tree; adding, removing or renaming a file changes it"""
+    try:
+        mtimes[folder_data["path"]] = os.stat(folder_data["path"]).st_mtime_ns
+    except OSError:
+        mtimes[folder_data["path"]] = -1
+    for subfolder in folder_data.get("subfolders", []):
+        _directory_mtimes(subfolder, mtimes)
+    return mtimes
+
+
+CHANGE_EVENT_TYPES = {"created", "deleted", "modified", "moved", "closed"}
+
+class _ArchiveEventHandler(FileSystemEventHandler):
+    def __init__(self, index: "ArchiveIndex"):
+        self.index = index
+
+    def on_any_event(self, event):
+        # Our own scans open every file, so ignore the open/read notifications
+        if event.event_type not in CHANGE_EVENT_TYPES:
+            return
+        self.index.mark_changed(event.src_path)
+        dest_path = getattr(event, "dest_path", None)
+        if dest_path:
+            self.index.mark_changed(dest_path)
+
+
+class ArchiveIndex:
+    """
+    In-memory folder structures of every deck under the configured roots.
+    Memory is bounded by the total number of records: one per file, one per polled directory
+    mtime and, in polling mode, one per polled file stat. Least recently used decks are
+    evicted first and scanned again the next time they are asked for.
+    """
+
+    def __init__(self, roots: List[str], scan_folder: Callable[[str, List[str]], Dict[str, Any]],
+                 max_files: int = ARCHIVE_INDEX_MAX_FILES, poll_seconds: float = ARCHIVE_INDEX_POLL_SECONDS):
+        self.roots = [os.path.normpath(os.path.abspath(root)) for root in roots]
+        self.scan_folder = scan_folder
+        self.max_files = max_files
+        self.poll_seconds = poll_seconds
+        # scan_folder(path, fields) must keep files PIL cannot open, marked with UNREADABLE_MARKER
+        # deck_path -> {"tree", "fields", "file_count", "records", "scanned_at", "verified_at", "dir_mtimes", "file_stats", "stale"}
+        self._decks: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._root_mtimes: Dict[str, int] = {}
+        self._file_count = 0
+        self._record_count = 0
+        self._lock = threading.RLock()
+        self._dirty = set()
+        self._dirty_event = threading.Event()
+        self._stop = threading.Event()
+        self._observer = None
+        self._threads: List[threading.Thread] = []
+
+    @property
+    def watch_mode(self) -> str:
+        return "inotify+polling" if self._observer is not None else "polling"
+
+    def deck_for_path(self, path: str) -> Optional[str]:
+        """The deck folder (direct child of a root) that contains path, if any"""
+        path = os.path.normpath(os.path.abspath(path))
+        for root in self.roots:
+            if path.startswith(root + os.sep):
+                relative = os.path.relpath(path, root)
+                return os.path.join(root, relative.split(os.sep)[0])
+        return None
+
+    # Lifecycle
+
+    def start(self):
+        if Observer is not None:
+            try:
+                observer = Observer()
+                handler = _ArchiveEventHandler(self)
+                for root in self.roots:
+                    observer.schedule(handler, root, recursive=True)
+                observer.start()
+                self._observer = observer
+            except Exception as e:
+                # Typically the inotify watch limit, polling still covers us
+                print(f"[ERROR] Could not start filesystem watcher, falling back to polling: {str(e)}")
+                self._observer = None
+        else:
+            print("[DEBUG] watchdog is not installed, archive index uses mtime polling only")
+
+        for target in (self._populate, self._refresh_worker, self._poll_worker):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        self._dirty_event.set()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+
+    def _list_decks(self, root: str) -> List[str]:
+        try:
+            with os.scandir(root) as entries:
+                return [entry.path for entry in entries if entry.is_dir() and not entry.name.startswith('.')]
+        except OSError as e:
+            print(f"[ERROR] Could not list archive root {root}: {str(e)}")
+            return []
+
+    def _populate(self):
+        for root in self.roots:
+            try:
+                self._root_mtimes[root] = os.stat(root).st_mtime_ns
+            except OSError:
+                continue
+            for deck_path in self._list_decks(root):
+                if self._stop.is_set():
+                    return
+                if self._record_count >= self.max_files:
+                    print(f"[DEBUG] Archive index full ({self._record_count} records), remaining decks load on demand")
+                    return
+                self.refresh_deck(deck_path)
+        print(f"[DEBUG] Archive index populated: {len(self._decks)} decks, {self._file_count} files")
+
+    # Change tracking
+
+    def mark_changed(self, path: str):
+        deck_path = self.deck_for_path(path)
+        if deck_path is None:
+            return
+        with self._lock:
+            entry = self._decks.get(deck_path)
+            if entry is not None:
+                entry["stale"] = True
+            self._dirty.add(deck_path)
+        self._dirty_event.set()
+
+    def _refresh_worker(self):
+        while not self._stop.is_set():
+            self._dirty_event.wait()
+            if self._stop.is_set():
+                return
+            time.sleep(ARCHIVE_INDEX_DEBOUNCE_SECONDS)
+            with self._lock:
+                dirty, self._dirty = self._dirty, set()
+                self._dirty_event.clear()
+            for deck_path in dirty:
+                with self._lock:
+                    evicted = deck_path not in self._decks and self._record_count >= self.max_files
+                if evicted:
+                    continue  # Scanned again on demand
+                self.refresh_deck(deck_path)
+
+    def _poll_worker(self):
+        while not self._stop.wait(self.poll_seconds):
+            for root in self.roots:
+                try:
+                    mtime_ns = os.stat(root).st_mtime_ns
+                except OSError:
+                    continue
+                if self._root_mtimes.get(root) != mtime_ns:
+                    # Decks were added, removed or renamed
+                    self._root_mtimes[root] = mtime_ns
+                    current = set(self._list_decks(root))
+                    with self._lock:
+                        known = {d for d in self._decks if os.path.dirname(d) == root}
+                    for deck_path in current ^ known:
+                        self.mark_changed(deck_path)
+
+            with self._lock:
+                decks = [(path, entry["dir_mtimes"], entry["file_stats"]) for path, entry in self._decks.items()]
+            for deck_path, dir_mtimes, file_stats in decks:
+                changed = any(
+                    self._stat_mtime(directory) != mtime_ns for directory, mtime_ns in dir_mtimes.items()
+                ) or any(
+                    # A file being copied in place grows without touching its directory's mtime.
+                    # Only kept in polling mode, the watcher reports those writes itself.
+                    _stat_file(file_path) != stat for file_path, stat in file_stats.items()
+                )
+                if changed:
+                    self.mark_changed(deck_path)
+                else:
+                    with self._lock:
+                        if deck_path in self._decks:
+                            self._decks[deck_path]["verified_at"] = time.time()
+
+    @staticmethod
+    def _stat_mtime(path: str) -> int:
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return -1
+
+    # Scanning and lookups
+
+    def refresh_deck(self, deck_path: str) -> Optional[Dict[str, Any]]:
+        """Scan a deck and replace its entry; drops the entry if the deck folder is gone"""
+        if not os.path.isdir(deck_path):
+            self._drop_deck(deck_path)
+            return None
+
+        fields = default_fields()
+        tree = self.scan_folder(deck_path, fields)
+        now = time.time()
+        entry = {
+            "tree": tree,
+            "fields": fields,
+            "file_count": _count_files(tree),
+            "scanned_at": now,
+            "verified_at": now,
+            "dir_mtimes": _directory_mtimes(tree, {}),
+            "file_stats": _file_stats(tree, {}) if self._observer is None else {},
+            "stale": False,
+        }
+        entry["records"] = entry["file_count"] + len(entry["dir_mtimes"]) + len(entry["file_stats"])
+        with self._lock:
+            self._drop_deck(deck_path)
+            self._decks[deck_path] = entry
+            self._file_count += entry["file_count"]
+            self._record_count += entry["records"]
+            self._evict()
+        return entry
+
+    def _drop_deck(self, deck_path: str):
+        with self._lock:
+            entry = self._decks.pop(deck_path, None)
+            if entry is not None:
+                self._file_count -= entry["file_count"]
+                self._record_count -= entry["records"]
+
+    def _evict(self):
+        # Keep the entry that was just added even if it alone exceeds the limit
+        while self._record_count > self.max_files and len(self._decks) > 1:
+            deck_path, entry = self._decks.popitem(last=False)
+            self._file_count -= entry["file_count"]
+            self._record_count -= entry["records"]
+            print(f"[DEBUG] Evicted {deck_path} from archive index")
+
+    def refresh_all(self):
+        for root in self.roots:
+            if not os.path.isdir(root):
+                continue  # Mount is down, keep what we have rather than dropping every deck
+            current = self._list_decks(root)
+            with self._lock:
+                gone = [d for d in self._decks if os.path.dirname(d) == root and d not in current]
+            for deck_path in gone:
+                self._drop_deck(deck_path)
+            for deck_path in current:
+                self.refresh_deck(deck_path)
+
+    def lookup(self, folder_path: str, fields: Optional[List[str]] = None) -> Optional[Dict[str, Any]]:
+        """
+        Folder structure for a folder inside a watched deck, projected to fields, with an
+        "index" entry describing how fresh it is. Returns None for folders the index does not cover
+        and for fields it was not scanned with (e.g. probes registered with default=False).
+        """
+        target = os.path.normpath(os.path.abspath(folder_path))
+        deck_path = self.deck_for_path(target)
+        if deck_path is None:
+            return None
+
+        served_from_index = True
+        with self._lock:
+            entry = self._decks.get(deck_path)
+            if entry is not None:
+                self._decks.move_to_end(deck_path)
+        if entry is None:
+            served_from_index = False
+            entry = self.refresh_deck(deck_path)
+            if entry is None:
+                return None
+
+        if fields is None:
+            fields = entry["fields"]
+        if any(f not in entry["fields"] and f not in DECK_LEVEL_FIELDS for f in fields):
+            return None  # Let the caller run the probes for those fields in a direct scan
+
+        subtree = find_subtree(entry["tree"], target)
+        if subtree is None:
+            return None  # Filtered folder (e.g. "temp"), let the caller scan it directly
+
+        result = _project_indexed(subtree, fields, include_unreadable=not needs_image(select_probes(fields)))
+        now = time.time()
+        result["index"] = {
+            "served_from_index": served_from_index,
+            "stale": entry["stale"],
+            "scanned_at": entry["scanned_at"],
+            "age_seconds": round(now - entry["verified_at"], 3),
+            "watch_mode": self.watch_mode,
+        }
+        return result
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "roots": self.roots,
+                "watch_mode": self.watch_mode,
+                "decks": len(self._decks),
+                "files": self._file_count,
+                "records": self._record_count,
+                "max_files": self.max_files,
+                "stale_decks": sorted(p for p, e in self._decks.items() if e["stale"]),
+                "poll_seconds": self.poll_seconds,
+            }
+
+
+archive_index: Optional[ArchiveIndex] = None
+
+
+def start_archive_index(scan_folder: Callable[[str, List[str]], Dict[str, Any]]) -> Optional[ArchiveIndex]:
+    """Create and start the index if ARCHIVE_ROOTS is configured"""
+    global archive_index
+    roots = [root for root in ARCHIVE_ROOTS if os.path.isdir(root)]
+    if not roots:
+        return None
+    archive_index = ArchiveIndex(roots, scan_folder)
+    archive_index.start()
+    print(f"[DEBUG] Archive index watching {archive_index.roots} ({archive_index.watch_mode})")
+    return archive_index
+
+
+def stop_archive_index():
+    if archive_index is not None:
+        archive_index.stop()
+
+
+def lookup_folder_structure(folder_path: str, fields: Optional[List[str]] = None) -> Optional[Dict[str, Any]]:
+    """Serve a folder from the archive index, or None when it is disabled or doesn't cover the folder"""
+    if archive_index is None:
+        return None
+    try:
+        return archive_index.lookup(folder_path, fields)
+    except Exception as e:
+        print(f"[ERROR] Archive index lookup failed for {folder_path}: {str(e)}")
+        return None
+
+
+def add_archive_index_routes(app: FastAPI):
+    """Add archive index status and forced-refresh routes to the FastAPI app"""
+
+    @app.get("/archive-index/status")
+    async def api_archive_index_status():
+        if archive_index is None:
+            return {"enabled": False}
+        return {"enabled": True, **archive_index.status()}
+
+    @app.post("/archive-index/refresh")
+    async def api_archive_index_refresh(request: ArchiveIndexRefreshRequest):
+        if archive_index is None:
+            raise HTTPException(status_code=400, detail="Archive index is not enabled, set ARCHIVE_ROOTS")
+
+        if request.path:
+            deck_path = archive_index.deck_for_path(request.path.strip())
+            if deck_path is None:
+                raise HTTPException(status_code=400, detail="Path is not inside a watched archive root")
+            await run_in_threadpool(archive_index.refresh_deck, deck_path)
+            return {"status": "success", "refreshed": [deck_path]}
+
+        await run_in_threadpool(archive_index.refresh_all)
+        return {"status": "success", **archive_index.status()}
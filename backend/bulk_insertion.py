@@ -1,14 +1,23 @@
 from fastapi import FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 import os
 import csv
-from PIL import Image
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Iterator
 import re
+from verification import verify_folder_structure, check_verify_options
+from archive_index import lookup_folder_structure
+from result_spool import ResultSpool
+from probes import UNREADABLE_MARKER, resolve_fields, select_probes, needs_image, build_file_record
 
 class CSVProcessRequest(BaseModel):
     csv_file_path: str
     folders_base_path: str
+    verify: str = "none"  # none, quick or sampled; checks cost extra reads per file, so callers opt in
+    sample_fraction: float = 0.0
+    time_budget_seconds: Optional[float] = None
+    fields: Optional[str] = None  # e.g. "name,size" or a preset like "counts-only"; default is every field
+    memory_limit_mb: Optional[int] = None  # Spill finished deck results to disk above this RSS
 
 # Updated header aliases to match your exact CSV headers
 HEADER_ALIASES = {
@@ -322,21 +331,20 @@ def create_header_mapping(csv_headers: List[str]) -> Dict[str, str]:
     
     return header_mapping
 
-def read_and_normalize_csv(csv_path: str) -> List[Dict[str, str]]:
-    """Read CSV file and normalize all rows with proper header mapping"""
-    normalized_rows = []
-    
+def iter_normalized_csv(csv_path: str, log_rows: bool = True) -> Iterator[Dict[str, str]]:
+    """Read CSV file row by row and normalize each row with proper header mapping"""
     with open(csv_path, 'r', encoding='utf-8') as file:
         # Read the CSV file
         csv_reader = csv.DictReader(file)
         
         # Get the actual headers from CSV
         actual_headers = csv_reader.fieldnames
-        print(f"[DEBUG] Actual CSV Headers: {actual_headers}")
         
         # Create header mapping
         header_mapping = create_header_mapping(actual_headers)
-        print(f"[DEBUG] Header Mapping: {header_mapping}")
+        if log_rows:
+            print(f"[DEBUG] Actual CSV Headers: {actual_headers}")
+            print(f"[DEBUG] Header Mapping: {header_mapping}")
         
         # Read and normalize all rows
         for row_index, row in enumerate(csv_reader):
@@ -348,14 +356,12 @@ def read_and_normalize_csv(csv_path: str) -> List[Dict[str, str]]:
                 normalized_row[canonical_key] = value or ""  # Handle None values
             
             # Debug first few rows
-            if row_index < 3:
+            if log_rows and row_index < 3:
                 print(f"[DEBUG] Row {row_index + 1} Original: {dict(row)}")
                 print(f"[DEBUG] Row {row_index + 1} Normalized: {normalized_row}")
                 print(f"[DEBUG] deck_name value: '{normalized_row.get('deck_name', 'NOT FOUND')}'")
             
-            normalized_rows.append(normalized_row)
-    
-    return normalized_rows
+            yield normalized_row
 
 # Helper functions (keeping your existing ones)
 def extract_trailing_number(folder_name: str) -> int:
@@ -363,65 +369,96 @@ def extract_trailing_number(folder_name: str) -> int:
     match = re.search(r'(\d+)(?!.*\d)', folder_name)
     return int(match.group(1)) if match else float('inf')
 
-def get_color_depth(img):
-    try:
-        mode = img.mode
-        is_16bit_per_channel = False
-
-        if hasattr(img, 'tag_v2') and img.tag_v2 is not None:
-            bits_per_sample = img.tag_v2.get(258)
-            if bits_per_sample:
-                if isinstance(bits_per_sample, (list, tuple)):
-                    if any(b == 16 for b in bits_per_sample):
-                        is_16bit_per_channel = True
-                elif bits_per_sample == 16:
-                    is_16bit_per_channel = True
-
-        if img.format in ['TIFF', 'PNG'] and 'transparency' not in img.info:
-            if hasattr(img, 'getextrema'):
-                try:
-                    extrema = img.getextrema()
-                    if isinstance(extrema, tuple) and len(extrema) == 2:
-                        if extrema[1] > 255:
-                            is_16bit_per_channel = True
-                except:
-                    pass
-
-        mode_map = {
-            "1": "1-bit",
-            "L": "16-bit grayscale" if is_16bit_per_channel else "8-bit grayscale",
-            "P": "8-bit palette",
-            "RGB": "48-bit RGB" if is_16bit_per_channel else "24-bit RGB",
-            "RGBA": "64-bit RGBA" if is_16bit_per_channel else "32-bit RGBA",
-            "CMYK": "64-bit CMYK" if is_16bit_per_channel else "32-bit CMYK",
-            "YCbCr": "48-bit YCbCr" if is_16bit_per_channel else "24-bit YCbCr",
-            "LAB": "48-bit LAB" if is_16bit_per_channel else "24-bit LAB",
-            "HSV": "48-bit HSV" if is_16bit_per_channel else "24-bit HSV",
-            "LA": "32-bit grayscale with alpha" if is_16bit_per_channel else "16-bit grayscale with alpha",
-            "PA": "16-bit palette with alpha",
-            "I": "32-bit integer",
-            "F": "32-bit float"
-        }
+# Archive-wide deck index: one scandir of folders_base_path, reused for every CSV row.
+# Cached per base path and rebuilt only when the base directory's mtime changes
+# (adding, removing or renaming a deck folder updates it).
+_deck_index_cache: Dict[str, Dict[str, Any]] = {}
 
-        return mode_map.get(mode, f"Unknown mode: {mode}")
-    except Exception as e:
-        return f"Error extracting color depth: {str(e)}"
+def normalize_deck_id(name: str) -> str:
+    """Case-insensitive form of a deck id with '_', '-' and spaces treated alike"""
+    return re.sub(r'[\s_\-]+', '-', name.strip().casefold())
 
-def make_dpi_serializable(dpi_value):
-    if dpi_value is None:
-        return None
-    try:
-        if isinstance(dpi_value, tuple):
-            return tuple(float(x) if hasattr(x, "__float__") else x for x in dpi_value)
-        elif hasattr(dpi_value, "__float__"):
-            return float(dpi_value)
-        else:
-            return "Unknown"
-    except Exception:
-        return "Unknown"
-
-def get_folder_structure(root_path):
-    """Get folder structure with enhanced filtering of hidden files and directories"""
+def numeric_deck_key(name: str) -> str:
+    """Normalized deck id with leading zeros dropped from the trailing number (TP_DBU-0001 -> tp-dbu-1)"""
+    normalized = normalize_deck_id(name)
+    number = extract_trailing_number(normalized)
+    if number == float('inf'):
+        return normalized
+    return re.sub(r'(\d+)(?!.*\d)', str(number), normalized)
+
+def deck_suffix_aliases(name: str) -> List[str]:
+    """
+    Numeric keys for a folder name with trailing suffix segments removed,
+    e.g. TP_DBU-0001-W03 -> ["tp-dbu-1"]. Only prefixes that still end in a number are kept,
+    so TP_DBU-0001-W03 never matches a bare "TP_DBU".
+    """
+    parts = normalize_deck_id(name).split('-')
+    aliases = []
+    for end in range(len(parts) - 1, 0, -1):
+        prefix = '-'.join(parts[:end])
+        if prefix and prefix[-1].isdigit():
+            aliases.append(numeric_deck_key(prefix))
+    return aliases
+
+def build_deck_index(folders_base_path: str) -> Dict[str, Any]:
+    """Build (or reuse) the deck index for a base path with a single scandir"""
+    mtime_ns = os.stat(folders_base_path).st_mtime_ns
+    cached = _deck_index_cache.get(folders_base_path)
+    if cached and cached["mtime_ns"] == mtime_ns:
+        print(f"[DEBUG] Reusing deck index for {folders_base_path} ({len(cached['exact'])} folders)")
+        return cached
+
+    index = {"mtime_ns": mtime_ns, "exact": {}, "normalized": {}, "numeric": {}, "suffix": {}}
+    with os.scandir(folders_base_path) as entries:
+        for entry in entries:
+            if not entry.is_dir():
+                continue
+            index["exact"][entry.name] = entry.path
+            index["normalized"].setdefault(normalize_deck_id(entry.name), []).append(entry.path)
+            index["numeric"].setdefault(numeric_deck_key(entry.name), []).append(entry.path)
+            for alias in deck_suffix_aliases(entry.name):
+                index["suffix"].setdefault(alias, []).append(entry.path)
+
+    print(f"[DEBUG] Built deck index for {folders_base_path} ({len(index['exact'])} folders)")
+    _deck_index_cache[folders_base_path] = index
+    return index
+
+def resolve_deck_folder(index: Dict[str, Any], deck_id: str) -> Dict[str, Any]:
+    """
+    Find the folder for a deck id, trying the strictest match first:
+    exact name, case/separator-insensitive name, same trailing number, then folders
+    that only differ by a trailing suffix (TP_DBU-0001 -> TP_DBU-0001-W03).
+    The first tier with any candidates decides; more than one candidate there is ambiguous.
+    """
+    if deck_id in index["exact"]:
+        return {"status": "matched", "match": "exact", "folder_path": index["exact"][deck_id]}
+
+    tiers = [
+        ("normalized", normalize_deck_id(deck_id)),
+        ("numeric", numeric_deck_key(deck_id)),
+        ("suffix", numeric_deck_key(deck_id)),
+    ]
+    for tier, key in tiers:
+        candidates = sorted(set(index[tier].get(key, [])), key=lambda p: extract_trailing_number(os.path.basename(p)))
+        if len(candidates) == 1:
+            return {"status": "matched", "match": tier, "folder_path": candidates[0]}
+        if len(candidates) > 1:
+            return {"status": "ambiguous", "match": tier, "folder_path": None, "candidates": candidates}
+
+    return {"status": "missing", "match": None, "folder_path": None}
+
+def get_folder_structure(root_path, fields=None, keep_unreadable=False):
+    """
+    Get folder structure with enhanced filtering of hidden files and directories.
+    fields limits the file record to the given fields (see probes.resolve_fields); only the
+    probes those fields need are run, so a listing without image fields never opens a file.
+    keep_unreadable keeps files PIL cannot open, with only their cheap fields and the
+    UNREADABLE_MARKER set, so the archive index can also answer listings that never open files.
+    """
+    if fields is None:
+        fields = resolve_fields(None)
+    probes = select_probes(fields)
+    open_images = needs_image(probes)
     folder_structure = {"path": root_path, "files": [], "subfolders": []}
     
     try:
@@ -454,31 +491,26 @@ def get_folder_structure(root_path):
                             continue
                     except (AttributeError, OSError):
                         pass  # Ignore if we can't check attributes
-                
-                extension = os.path.splitext(file)[-1].lower()
-                file_info = {
-                    "name": file,
-                    "path": file_path,
-                    "extension": extension,
-                    "size": os.path.getsize(file_path),
-                }
-
-                # Only process files that PIL can successfully open
+
+                # When image fields are requested, only keep files that PIL can successfully open
                 try:
-                    with Image.open(file_path) as img:
-                        file_info["resolution"] = img.size
-                        dpi = img.info.get("dpi")
-                        file_info["dpi"] = make_dpi_serializable(dpi)
-                        file_info["color_depth"] = get_color_depth(img)
-                        
-                        # Add the file only if PIL can successfully open it
-                        current_folder["files"].append(file_info)
-                        valid_files_count += 1
+                    file_info = build_file_record(file_path, probes, fields)
+                    current_folder["files"].append(file_info)
+                    valid_files_count += 1
+                    if open_images:
                         print(f"[DEBUG] Added valid image: {file}")
-                        
                 except Exception as e:
-                    print(f"[DEBUG] Skipping {file}: PIL error - {str(e)}")
-                    # Don't add files that can't be opened by PIL
+                    if keep_unreadable and open_images:
+                        try:
+                            file_info = build_file_record(
+                                file_path, [p for p in probes if not p["needs_image"]], fields
+                            )
+                            file_info[UNREADABLE_MARKER] = True
+                            current_folder["files"].append(file_info)
+                            continue
+                        except Exception:
+                            pass
+                    print(f"[DEBUG] Skipping {file}: probe error - {str(e)}")
 
             print(f"[DEBUG] Processed {valid_files_count} valid images in {root}")
 
@@ -486,14 +518,17 @@ def get_folder_structure(root_path):
             valid_subdirs = [d for d in sorted(dirs, key=extract_trailing_number) if is_valid_directory(d)]
             for subdir in valid_subdirs:
                 subfolder_path = os.path.join(root, subdir)
-                subfolder_data = get_folder_structure(subfolder_path)
+                subfolder_data = get_folder_structure(subfolder_path, fields, keep_unreadable)
                 current_folder["subfolders"].append(subfolder_data)
 
             if root == root_path:
                 folder_structure = current_folder
 
+            # Subfolders were scanned recursively above, don't let os.walk visit them again
+            break
+
         # Count only valid images
-        total_images = len(folder_structure["files"])
+        total_images = sum(1 for f in folder_structure["files"] if UNREADABLE_MARKER not in f)
         for subfolder in folder_structure.get("subfolders", []):
             total_images += subfolder.get("totalImages", 0)
 
@@ -533,19 +568,51 @@ def parse_subworks(subworks_text):
             subworks.append(parsed_subwork)
     return subworks
 
-def process_csv(app, csv_path, folders_base_path):
+def process_csv(app, csv_path, folders_base_path, verify="none", sample_fraction=0.0, time_budget_seconds=None,
+                fields=None, memory_limit_mb=None):
     if not os.path.exists(csv_path) or not os.path.isfile(csv_path):
         raise HTTPException(status_code=400, detail="Invalid CSV file path")
     if not os.path.exists(folders_base_path) or not os.path.isdir(folders_base_path):
         raise HTTPException(status_code=400, detail="Invalid folders base path")
+    try:
+        check_verify_options(verify, sample_fraction, time_budget_seconds)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        selected_fields = resolve_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if "integrity" not in selected_fields:
+        verify = "none"
 
-    result = []
+    result = ResultSpool(memory_limit_mb)
 
     try:
-        # Read and normalize all CSV rows first
-        normalized_rows = read_and_normalize_csv(csv_path)
-        
-        for row_index, row in enumerate(normalized_rows):
+        # Resolve every deck id against one index of the base path and report problems up front.
+        # Rows are streamed from the CSV twice (ids first, then the rows themselves) instead of being held in memory.
+        deck_index = build_deck_index(folders_base_path)
+        deck_matches = {}
+        deck_matching = {"fuzzy": {}, "ambiguous": {}, "missing": []}
+        for row in iter_normalized_csv(csv_path):
+            deck_id = row.get('deck_id', '').strip()
+            if not deck_id or deck_id in deck_matches:
+                continue
+            match = resolve_deck_folder(deck_index, deck_id)
+            deck_matches[deck_id] = match
+            if match["status"] == "missing":
+                deck_matching["missing"].append(deck_id)
+            elif match["status"] == "ambiguous":
+                deck_matching["ambiguous"][deck_id] = [os.path.basename(p) for p in match["candidates"]]
+            elif match["match"] != "exact":
+                deck_matching["fuzzy"][deck_id] = os.path.basename(match["folder_path"])
+        if deck_matching["missing"]:
+            print(f"⚠️  No folder found for deck ids: {deck_matching['missing']}")
+        if deck_matching["ambiguous"]:
+            print(f"⚠️  Ambiguous folders for deck ids: {deck_matching['ambiguous']}")
+        if deck_matching["fuzzy"]:
+            print(f"[DEBUG] Deck ids matched by normalized name: {deck_matching['fuzzy']}")
+
+        for row_index, row in enumerate(iter_normalized_csv(csv_path, log_rows=False)):
             deck_id = row.get('deck_id', '').strip()
             deck_name = row.get('deck_name', '').strip()
 
@@ -565,8 +632,15 @@ def process_csv(app, csv_path, folders_base_path):
             
             grantha_info = parse_grantha_info(row.get('grantha_name', ''))
             grantha_id = f"{deck_id}_{grantha_info['name'].replace(' ', '_')}"
-            folder_path = os.path.join(folders_base_path, deck_id)
-            folder_data = get_folder_structure(folder_path) if os.path.exists(folder_path) else {}
+            folder_path = deck_matches[deck_id]["folder_path"]
+            folder_data = {}
+            if folder_path:
+                folder_data = (
+                    lookup_folder_structure(folder_path, selected_fields)
+                    or get_folder_structure(folder_path, selected_fields)
+                )
+            # Sampling and the time budget apply per deck
+            verify_folder_structure(folder_data, verify, sample_fraction, time_budget_seconds)
             subworks_info = parse_subworks(row.get('subworks', ''))
 
             main_grantha_images = []
@@ -624,11 +698,14 @@ def process_csv(app, csv_path, folders_base_path):
                     "image_count": len(main_grantha_images)
                 },
                 "subworks": subworks_with_images,
-                "total_images": folder_data.get("totalImages", 0)
+                "total_images": folder_data.get("totalImages", 0),
+                "verification": folder_data.get("verification"),
+                "index": folder_data.get("index")
             })
 
-        return {"status": "success", "data": result}
+        return result.to_response({"status": "success", "deck_matching": deck_matching})
     except Exception as e:
+        result.close()
         raise HTTPException(status_code=500, detail=f"Error processing CSV: {str(e)}")
 
 # This is the missing function that your main.py is trying to import
@@ -639,4 +716,12 @@ def add_bulk_insertion_routes(app: FastAPI):
     async def api_process_csv(request: CSVProcessRequest):
         csv_path = request.csv_file_path.strip()
         folders_base_path = request.folders_base_path.strip()
-        return process_csv(app, csv_path, folders_base_path)
\ No newline at end of file
+        # Scans and sampled verification block for a while per deck, so run them in a worker thread
+        return await run_in_threadpool(
+            process_csv, app, csv_path, folders_base_path,
+            verify=request.verify,
+            sample_fraction=request.sample_fraction,
+            time_budget_seconds=request.time_budget_seconds,
+            fields=request.fields,
+            memory_limit_mb=request.memory_limit_mb,
+        )
\ No newline at end of file
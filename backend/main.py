@@ -1,12 +1,31 @@
 from fastapi import FastAPI
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse, JSONResponse
 from pydantic import BaseModel
 import os
-from PIL import Image
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from functools import partial
 from fastapi.middleware.cors import CORSMiddleware
-from bulk_insertion import add_bulk_insertion_routes, get_color_depth, is_valid_image_file, is_valid_directory
-import re
+from bulk_insertion import add_bulk_insertion_routes, get_folder_structure
+from archive_index import (
+    add_archive_index_routes, start_archive_index, stop_archive_index, lookup_folder_structure, find_subtree
+)
+from verification import verify_folder_structure, check_verify_options, shutdown_verification_pool
+from probes import resolve_fields, project_folder_structure
+from typing import Optional, List, Dict, Any
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Same scanner as direct scans, so results (and subfolder order) don't depend on ARCHIVE_ROOTS.
+    # It keeps files PIL cannot open so it can also serve listings that never open files.
+    start_archive_index(partial(get_folder_structure, keep_unreadable=True))
+    yield
+    stop_archive_index()
+    shutdown_verification_pool()
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Enable CORS for frontend communication
 app.add_middleware(
@@ -19,114 +38,21 @@ app.add_middleware(
 
 class FolderPathRequest(BaseModel):
     folder_path: str
-
-
-# Helper function to make DPI values JSON serializable
-def make_dpi_serializable(dpi_value):
-    if dpi_value is None:
-        return None
-    try:
-        if isinstance(dpi_value, tuple):
-            return tuple(float(x) if hasattr(x, "__float__") else x for x in dpi_value)
-        elif hasattr(dpi_value, "__float__"):
-            return float(dpi_value)
-        else:
-            return "Unknown"
-    except Exception:
-        return "Unknown"
-
-def get_folder_structure(root_path):
-    """Get folder structure with enhanced filtering of hidden files and directories"""
-    folder_structure = {"path": root_path, "files": [], "subfolders": []}
-
-    try:
-        for root, dirs, files in os.walk(root_path):
-            current_folder = {"path": root, "files": [], "subfolders": []}
-
-            # Filter out invalid directories in-place with detailed logging
-            original_dirs = dirs.copy()
-            dirs[:] = [d for d in dirs if is_valid_directory(d)]
-            filtered_out_dirs = set(original_dirs) - set(dirs)
-            if filtered_out_dirs:
-                print(f"[DEBUG] Filtered out directories: {filtered_out_dirs}")
-
-            # Process files with enhanced filtering
-            valid_files_count = 0
-            for file in files:
-                # Skip files that don't pass our enhanced validation
-                if not is_valid_image_file(file):
-                    continue
-
-                file_path = os.path.join(root, file)
-                
-                # Additional check: Skip if file is actually hidden (system attribute on Windows)
-                if os.name == 'nt':  # Windows
-                    import stat
-                    try:
-                        attrs = os.stat(file_path).st_file_attributes
-                        if attrs & stat.FILE_ATTRIBUTE_HIDDEN:
-                            print(f"[DEBUG] Skipping Windows hidden file: {file}")
-                            continue
-                    except (AttributeError, OSError):
-                        pass  # Ignore if we can't check attributes
-                
-                extension = os.path.splitext(file)[-1].lower()
-
-                file_info = {
-                    "name": file,
-                    "path": file_path,
-                    "extension": extension,
-                    "size": os.path.getsize(file_path),
-                }
-
-                # Process image files that passed validation
-                if extension in [".jpg", ".png", ".jpeg", ".webp", ".gif", ".tiff", ".tif", ".dng", ".bmp", ".raw"]:
-                    try:
-                        with Image.open(file_path) as img:
-                            file_info["resolution"] = img.size  # (width, height)
-                            file_info["dpi"] = make_dpi_serializable(img.info.get("dpi"))
-                            file_info["color_depth"] = get_color_depth(img)  # ✅ Add color depth
-                            
-                            # Only add to results if PIL can successfully process it
-                            current_folder["files"].append(file_info)
-                            valid_files_count += 1
-                            print(f"[DEBUG] Added valid image: {file}")
-                            
-                    except Exception as e:
-                        print(f"[DEBUG] Skipping {file}: PIL error - {str(e)}")
-                        # Don't add files that can't be opened by PIL
-                else:
-                    # For non-image files that passed validation, add without image processing
-                    current_folder["files"].append(file_info)
-                    valid_files_count += 1
-
-            print(f"[DEBUG] Processed {valid_files_count} valid files in {root}")
-
-            # Recursively process valid subfolders only
-            valid_subdirs = [d for d in dirs if is_valid_directory(d)]
-            for subdir in valid_subdirs:
-                subfolder_path = os.path.join(root, subdir)
-                subfolder_data = get_folder_structure(subfolder_path)
-                current_folder["subfolders"].append(subfolder_data)
-
-            if root == root_path:
-                folder_structure = current_folder
-
-        # Count total images in this folder and all subfolders (only valid images)
-        valid_image_extensions = [".jpg", ".png", ".jpeg", ".webp", ".gif", ".tiff", ".tif", ".dng", ".bmp", ".raw"]
-        total_images = sum(
-            1 for f in folder_structure["files"]
-            if os.path.splitext(f["name"])[-1].lower() in valid_image_extensions
-        )
-        for subfolder in folder_structure.get("subfolders", []):
-            total_images += subfolder.get("totalImages", 0)
-
-        print(f"[DEBUG] Total valid images found: {total_images}")
-        return {**folder_structure, "totalImages": total_images}
-        
-    except Exception as e:
-        print(f"[ERROR] Error processing folder structure for {root_path}: {str(e)}")
-        return {"path": root_path, "files": [], "subfolders": [], "totalImages": 0}
+    verify: str = "none"  # none, quick or sampled; checks cost extra reads per file, so callers opt in
+    sample_fraction: float = 0.0
+    time_budget_seconds: Optional[float] = None
+    fields: Optional[str] = None  # e.g. "name,size" or a preset like "counts-only"; default is every field
+
+class BatchFolderPathRequest(BaseModel):
+    folder_paths: List[str]
+    max_concurrency: int = 4  # Folder scans running at the same time
+    stream: bool = False  # Send one NDJSON line per path as soon as it is ready
+    verify: str = "none"
+    sample_fraction: float = 0.0
+    time_budget_seconds: Optional[float] = None
+    fields: Optional[str] = None  # e.g. "name,size" or a preset like "counts-only"; default is every field
+
+MAX_BATCH_CONCURRENCY = 16
 
 @app.post("/get-folder-details")
 async def get_folder_details(data: FolderPathRequest):
@@ -134,15 +60,118 @@ async def get_folder_details(data: FolderPathRequest):
 
     if not os.path.exists(folder_path) or not os.path.isdir(folder_path):
         return {"error": "Invalid folder path"}
+    try:
+        check_verify_options(data.verify, data.sample_fraction, data.time_budget_seconds)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    try:
+        fields = resolve_fields(data.fields)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
 
     try:
-        folder_data = get_folder_structure(folder_path)
-        return folder_data
+        # Sampled verification waits on the process pool, keep that off the event loop
+        return await run_in_threadpool(scan_and_verify, folder_path, data, fields)
     except Exception as e:
         return {"error": f"Error processing folder: {str(e)}"}
 
+def plan_folder_scans(folder_paths: List[str]) -> Dict[str, Optional[str]]:
+    """
+    Map every normalized folder path to the root whose scan covers it.
+    Roots map to None; paths nested inside another requested path map to that path,
+    so shared subtrees are scanned only once.
+    """
+    plan = {}
+    for path in sorted(set(folder_paths), key=len):
+        parent = next(
+            (root for root, covered_by in plan.items()
+             if covered_by is None and path.startswith(root.rstrip(os.sep) + os.sep)),
+            None,
+        )
+        plan[path] = parent
+    return plan
+
+def effective_verify_level(data, fields: List[str]) -> str:
+    """Integrity results are a field too, skip verification when the caller didn't ask for them"""
+    return data.verify if "integrity" in fields else "none"
+
+def scan_and_verify(folder_path: str, data, fields: List[str]) -> Dict[str, Any]:
+    folder_data = lookup_folder_structure(folder_path, fields) or get_folder_structure(folder_path, fields)
+    return verify_folder_structure(
+        folder_data, effective_verify_level(data, fields), data.sample_fraction, data.time_budget_seconds
+    )
+
+async def iter_batch_folder_details(data: BatchFolderPathRequest, fields: List[str]):
+    """Scan the requested folders concurrently and yield (requested_path, result) as each one finishes"""
+    semaphore = asyncio.Semaphore(max(1, min(data.max_concurrency, MAX_BATCH_CONCURRENCY)))
+    requested = {p: os.path.normpath(os.path.abspath(p.strip())) for p in data.folder_paths}
+    valid_paths = [p for p in set(requested.values()) if os.path.isdir(p)]
+    plan = plan_folder_scans(valid_paths)
+    root_tasks = {}
+
+    async def scan_root(path):
+        async with semaphore:
+            return await run_in_threadpool(scan_and_verify, path, data, fields)
+
+    async def resolve(path):
+        if path not in plan:
+            return {"error": "Invalid folder path"}
+        try:
+            root = plan[path]
+            if root is None:
+                return await root_tasks[path]
+
+            subtree = find_subtree(await root_tasks[root], path)
+            if subtree is None:
+                # Nested folder was filtered out of the parent scan (e.g. a "temp" folder), scan it on its own
+                return await scan_root(path)
+            # Copy the folders and file records, so verifying the nested result never writes into the parent's tree
+            return await run_in_threadpool(
+                verify_folder_structure, project_folder_structure(subtree, None), effective_verify_level(data, fields),
+                data.sample_fraction, data.time_budget_seconds
+            )
+        except Exception as e:
+            return {"error": f"Error processing folder: {str(e)}"}
+
+    for path, root in plan.items():
+        if root is None:
+            root_tasks[path] = asyncio.ensure_future(scan_root(path))
+
+    async def resolve_requested(original, path):
+        return original, await resolve(path)
+
+    try:
+        for next_done in asyncio.as_completed([resolve_requested(o, p) for o, p in requested.items()]):
+            yield await next_done
+    finally:
+        for task in root_tasks.values():
+            task.cancel()
+
+@app.post("/get-folder-details/batch")
+async def get_folder_details_batch(data: BatchFolderPathRequest):
+    try:
+        check_verify_options(data.verify, data.sample_fraction, data.time_budget_seconds)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    try:
+        fields = resolve_fields(data.fields)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+
+    if data.stream:
+        async def ndjson_lines():
+            async for folder_path, result in iter_batch_folder_details(data, fields):
+                yield json.dumps({"folder_path": folder_path, "result": result}) + "\n"
+        return StreamingResponse(ndjson_lines(), media_type="application/x-ndjson")
+
+    results = {}
+    async for folder_path, result in iter_batch_folder_details(data, fields):
+        results[folder_path] = result
+    return {"results": results}
+
 # Add the bulk insertion routes from separate file
 add_bulk_insertion_routes(app)
+add_archive_index_routes(app)
 
 if __name__ == "__main__":
     import uvicorn
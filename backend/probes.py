@@ -0,0 +1,181 @@
+import os
+from PIL import Image
+from typing import Callable, Dict, Any, List, Optional
+
+# Pluggable metadata probes for file records.
+#
+# A probe computes one or more fields of a file record. Probes with needs_image=True receive
+# the opened PIL image; the scanner opens each file at most once, and only if a selected probe
+# needs it. New expensive fields (hashes, EXIF, ...) should be registered with default=False so
+# callers only pay for them when they ask for them by name.
+#
+#   register_probe("sha256", ["sha256"], lambda file_path, img: {"sha256": hash_file(file_path)},
+#                  needs_image=False, default=False)
+
+PROBES: Dict[str, Dict[str, Any]] = {}
+
+# Always present, it comes from the directory listing itself
+ALWAYS_INCLUDED_FIELDS = ["name"]
+
+# Fields computed per deck after the scan (see verification.verify_folder_structure)
+DECK_LEVEL_FIELDS = ["integrity"]
+
+# Set on records of files PIL could not open, kept only by scans that ask for them (the archive index)
+UNREADABLE_MARKER = "_unreadable"
+
+FIELD_PRESETS = {
+    "counts-only": ["name"],
+    "listing": ["name", "path", "extension", "size"],
+}
+
+
+def register_probe(name: str, fields: List[str], func: Callable[[str, Any], Dict[str, Any]],
+                   needs_image: bool = False, default: bool = True):
+    """Register a probe. func(file_path, img) returns a dict with the probe's fields."""
+    PROBES[name] = {"fields": fields, "func": func, "needs_image": needs_image, "default": default}
+
+
+def default_fields() -> List[str]:
+    fields = list(ALWAYS_INCLUDED_FIELDS)
+    for probe in PROBES.values():
+        if probe["default"]:
+            fields.extend(probe["fields"])
+    return fields + DECK_LEVEL_FIELDS
+
+
+def known_fields() -> List[str]:
+    fields = list(ALWAYS_INCLUDED_FIELDS)
+    for probe in PROBES.values():
+        fields.extend(probe["fields"])
+    return fields + DECK_LEVEL_FIELDS
+
+
+def resolve_fields(spec: Optional[str]) -> List[str]:
+    """
+    Turn a fields option ("name,size", a preset like "counts-only", or None for everything
+    the scanner returned before field selection existed) into a list of field names.
+    """
+    if not spec or not spec.strip() or spec.strip() == "full":
+        return default_fields()
+    if spec.strip() in FIELD_PRESETS:
+        return list(FIELD_PRESETS[spec.strip()])
+
+    requested = [f.strip() for f in spec.split(",") if f.strip()]
+    unknown = [f for f in requested if f not in known_fields()]
+    if unknown:
+        raise ValueError(
+            f"Unknown fields {unknown}, expected any of {known_fields()} or a preset {list(FIELD_PRESETS)}"
+        )
+    return ALWAYS_INCLUDED_FIELDS + [f for f in requested if f not in ALWAYS_INCLUDED_FIELDS]
+
+
+def select_probes(fields: List[str]) -> List[Dict[str, Any]]:
+    """Probes needed to produce the requested fields"""
+    return [probe for probe in PROBES.values() if any(f in fields for f in probe["fields"])]
+
+
+def needs_image(probes: List[Dict[str, Any]]) -> bool:
+    return any(probe["needs_image"] for probe in probes)
+
+
+def build_file_record(file_path: str, probes: List[Dict[str, Any]], fields: List[str]) -> Dict[str, Any]:
+    """
+    Run the selected probes for one file. Raises if an image probe is selected and PIL cannot
+    open the file, so the scanner can skip it as before.
+    """
+    file_info = {"name": os.path.basename(file_path)}
+    image_probes = [probe for probe in probes if probe["needs_image"]]
+
+    for probe in probes:
+        if not probe["needs_image"]:
+            file_info.update(probe["func"](file_path, None))
+
+    if image_probes:
+        with Image.open(file_path) as img:
+            for probe in image_probes:
+                file_info.update(probe["func"](file_path, img))
+
+    # A probe may compute more fields than were asked for
+    return {key: value for key, value in file_info.items() if key in fields}
+
+
+def get_color_depth(img):
+    try:
+        mode = img.mode
+        is_16bit_per_channel = False
+
+        if hasattr(img, 'tag_v2') and img.tag_v2 is not None:
+            bits_per_sample = img.tag_v2.get(258)
+            if bits_per_sample:
+                if isinstance(bits_per_sample, (list, tuple)):
+                    if any(b == 16 for b in bits_per_sample):
+                        is_16bit_per_channel = True
+                elif bits_per_sample == 16:
+                    is_16bit_per_channel = True
+
+        if img.format in ['TIFF', 'PNG'] and 'transparency' not in img.info:
+            if hasattr(img, 'getextrema'):
+                try:
+                    extrema = img.getextrema()
+                    if isinstance(extrema, tuple) and len(extrema) == 2:
+                        if extrema[1] > 255:
+                            is_16bit_per_channel = True
+                except:
+                    pass
+
+        mode_map = {
+            "1": "1-bit",
+            "L": "16-bit grayscale" if is_16bit_per_channel else "8-bit grayscale",
+            "P": "8-bit palette",
+            "RGB": "48-bit RGB" if is_16bit_per_channel else "24-bit RGB",
+            "RGBA": "64-bit RGBA" if is_16bit_per_channel else "32-bit RGBA",
+            "CMYK": "64-bit CMYK" if is_16bit_per_channel else "32-bit CMYK",
+            "YCbCr": "48-bit YCbCr" if is_16bit_per_channel else "24-bit YCbCr",
+            "LAB": "48-bit LAB" if is_16bit_per_channel else "24-bit LAB",
+            "HSV": "48-bit HSV" if is_16bit_per_channel else "24-bit HSV",
+            "LA": "32-bit grayscale with alpha" if is_16bit_per_channel else "16-bit grayscale with alpha",
+            "PA": "16-bit palette with alpha",
+            "I": "32-bit integer",
+            "F": "32-bit float"
+        }
+
+        return mode_map.get(mode, f"Unknown mode: {mode}")
+    except Exception as e:
+        return f"Error extracting color depth: {str(e)}"
+
+def make_dpi_serializable(dpi_value):
+    if dpi_value is None:
+        return None
+    try:
+        if isinstance(dpi_value, tuple):
+            return tuple(float(x) if hasattr(x, "__float__") else x for x in dpi_value)
+        elif hasattr(dpi_value, "__float__"):
+            return float(dpi_value)
+        else:
+            return "Unknown"
+    except Exception:
+        return "Unknown"
+
+
+register_probe("path", ["path"], lambda file_path, img: {"path": file_path})
+register_probe("extension", ["extension"], lambda file_path, img: {"extension": os.path.splitext(file_path)[-1].lower()})
+register_probe("size", ["size"], lambda file_path, img: {"size": os.path.getsize(file_path)})
+register_probe("resolution", ["resolution"], lambda file_path, img: {"resolution": img.size}, needs_image=True)
+register_probe("dpi", ["dpi"], lambda file_path, img: {"dpi": make_dpi_serializable(img.info.get("dpi"))}, needs_image=True)
+register_probe("color_depth", ["color_depth"], lambda file_path, img: {"color_depth": get_color_depth(img)}, needs_image=True)
+
+
+def project_folder_structure(folder_data: Dict[str, Any], fields: Optional[List[str]]) -> Dict[str, Any]:
+    """
+    Copy of an already scanned folder structure with file records reduced to fields
+    (all fields when None). The original is never modified, so it can be shared between callers.
+    """
+    projected = {key: value for key, value in folder_data.items() if key not in ("files", "subfolders")}
+    projected["files"] = [
+        {key: value for key, value in file_info.items() if fields is None or key in fields}
+        for file_info in folder_data.get("files", [])
+    ]
+    projected["subfolders"] = [
+        project_folder_structure(subfolder, fields) for subfolder in folder_data.get("subfolders", [])
+    ]
+    return projected
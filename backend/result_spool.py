@@ -0,0 +1,161 @@
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+import os
+import gc
+import json
+import tempfile
+import threading
+from typing import Dict, Any, List, Optional
+
+# Spill files go to the system temp dir unless SPILL_DIR points somewhere with more room
+SPILL_DIR = os.environ.get("SPILL_DIR") or None
+# RSS is sampled in the background while a run is going, so the peak inside a deck's scan is seen too
+RSS_SAMPLE_SECONDS = float(os.environ.get("RSS_SAMPLE_SECONDS", "0.05"))
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def current_rss_bytes() -> Optional[int]:
+    """Resident set size of this process, or None if the platform gives us no way to read it"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    # Only the lifetime peak is available here
+    return process_peak_rss_bytes()
+
+
+def process_peak_rss_bytes() -> Optional[int]:
+    """Highest RSS of the whole process lifetime, as reported by the OS"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if os.uname().sysname == "Darwin" else peak * 1024
+
+
+def _to_mb(value: Optional[int]) -> Optional[float]:
+    return round(value / (1024 * 1024), 1) if value is not None else None
+
+
+class ResultSpool:
+    """
+    Ordered, append-only store for per-deck results of one process_csv run.
+
+    Results stay in memory until the process RSS goes over memory_limit_mb. From then on
+    everything held in memory is written to a temporary JSONL file and each new result goes
+    straight to that file, so the run no longer grows with the size of the archive.
+    Without a limit it behaves like a plain list, only tracking peak RSS.
+    """
+
+    def __init__(self, memory_limit_mb: Optional[int] = None):
+        self.memory_limit_bytes = memory_limit_mb * 1024 * 1024 if memory_limit_mb else None
+        self.records: List[Dict[str, Any]] = []
+        self.spill_path: Optional[str] = None
+        self.spilled_count = 0
+        self.start_rss = current_rss_bytes()
+        self.peak_rss = self.start_rss
+        self._sampler_stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample_rss, daemon=True)
+        self._sampler.start()
+
+    def _sample_rss(self):
+        while not self._sampler_stop.wait(RSS_SAMPLE_SECONDS):
+            self._record_rss(current_rss_bytes())
+
+    def _record_rss(self, rss: Optional[int]):
+        if rss is not None and (self.peak_rss is None or rss > self.peak_rss):
+            self.peak_rss = rss
+
+    def _stop_sampler(self):
+        self._sampler_stop.set()
+        if self._sampler.is_alive() and self._sampler is not threading.current_thread():
+            self._sampler.join()
+
+    @property
+    def spilled(self) -> bool:
+        return self.spill_path is not None
+
+    def append(self, record: Dict[str, Any]):
+        if self.spilled:
+            self._write([record])
+        else:
+            self.records.append(record)
+
+        rss = current_rss_bytes()
+        self._record_rss(rss)
+        # If RSS cannot be read at all we cannot tell when to stop, so a limit means spill right away
+        if self.memory_limit_bytes and not self.spilled and (rss is None or rss > self.memory_limit_bytes):
+            print(f"[DEBUG] RSS {_to_mb(rss)} MB over the {_to_mb(self.memory_limit_bytes)} MB limit, spilling results to disk")
+            self._write(self.records)
+            self.records = []
+            gc.collect()
+
+    def _write(self, records: List[Dict[str, Any]]):
+        if self.spill_path is None:
+            fd, self.spill_path = tempfile.mkstemp(prefix="process_csv_", suffix=".jsonl", dir=SPILL_DIR)
+            os.close(fd)
+        with open(self.spill_path, "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+        self.spilled_count += len(records)
+
+    def __len__(self) -> int:
+        return self.spilled_count + len(self.records)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "memory_limit_mb": _to_mb(self.memory_limit_bytes),
+            "start_rss_mb": _to_mb(self.start_rss),
+            "peak_rss_mb": _to_mb(self.peak_rss),
+            "process_peak_rss_mb": _to_mb(process_peak_rss_bytes()),
+            "spilled_records": self.spilled_count,
+        }
+
+    def close(self):
+        self._stop_sampler()
+        if self.spill_path is not None and os.path.exists(self.spill_path):
+            os.remove(self.spill_path)
+        self.spill_path = None
+        self.records = []
+
+    def to_response(self, envelope: Dict[str, Any]):
+        """
+        The run's response: a plain dict while everything fits in memory, otherwise a JSON
+        document streamed from the spill file (removed once the response is sent).
+        """
+        self._stop_sampler()
+        envelope = {**envelope, "memory": self.stats()}
+        print(f"[DEBUG] process_csv memory: {envelope['memory']}")
+        if not self.spilled:
+            return {**envelope, "data": self.records}
+
+        spill_file = open(self.spill_path, encoding="utf-8")
+        try:
+            # POSIX keeps the data readable through the open handle, so the file can never be left behind
+            os.remove(self.spill_path)
+        except OSError:
+            pass  # Windows: removed by close() once the response is done
+
+        def cleanup():
+            spill_file.close()
+            self.close()
+
+        def json_chunks():
+            yield json.dumps(envelope)[:-1] + ', "data": ['
+            # Spill lines are already JSON, pass them through without decoding
+            for i, line in enumerate(spill_file):
+                yield ("," if i else "") + line.rstrip("\n")
+            yield "]}"
+
+        return StreamingResponse(json_chunks(), media_type="application/json", background=BackgroundTask(cleanup))
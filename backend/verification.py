@@ -0,0 +1,274 @@
+import os
+import math
+import multiprocessing
+import random
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from typing import Dict, Any, List, Optional, Tuple
+from PIL import Image
+
+# Verification levels, cheapest first:
+#   none    - no checks, records are returned as scanned
+#   quick   - structural checks on every file (TIFF strip/tile extents, JPEG EOI, PNG IEND)
+#   sampled - quick checks on every file plus a full decode of a sample of leaves per deck
+VERIFY_LEVELS = ["none", "quick", "sampled"]
+
+TIFF_EXTENSIONS = [".tif", ".tiff", ".dng"]
+JPEG_EXTENSIONS = [".jpg", ".jpeg"]
+PNG_EXTENSIONS = [".png"]
+
+# TIFF tags describing where the image data lives
+TIFF_STRIP_OFFSETS = 273
+TIFF_STRIP_BYTE_COUNTS = 279
+TIFF_TILE_OFFSETS = 324
+TIFF_TILE_BYTE_COUNTS = 325
+
+JPEG_EOI = b"\xff\xd9"
+PNG_IEND = b"IEND\xaeB`\x82"
+# Some scanner software pads files after the end marker, so look a little before the end
+TAIL_WINDOW = 1024
+
+VERIFY_WORKERS = int(os.environ.get("VERIFY_WORKERS", "0")) or None  # None = one per CPU
+VERIFY_CACHE_MAX_ENTRIES = int(os.environ.get("VERIFY_CACHE_MAX_ENTRIES", "200000"))
+
+# (path, size, mtime_ns) -> {"quick": result, "decode": result}
+_verification_cache: "OrderedDict[Tuple[str, int, int], Dict[str, Dict[str, Any]]]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    """Lazily create the process pool shared by all sampled verifications"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # The server already runs other threads (archive index, RSS sampler, request workers), never fork it
+            _pool = ProcessPoolExecutor(max_workers=VERIFY_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def shutdown_verification_pool():
+    """Stop the decode workers, called when the app shuts down"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=True, cancel_futures=True)
+            _pool = None
+
+
+def _cache_key(file_path: str) -> Optional[Tuple[str, int, int]]:
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        return None
+    return (file_path, st.st_size, st.st_mtime_ns)
+
+
+def _cache_get(key, tier: str) -> Optional[Dict[str, Any]]:
+    if key is None:
+        return None
+    with _cache_lock:
+        entry = _verification_cache.get(key)
+        if entry is None:
+            return None
+        _verification_cache.move_to_end(key)
+        return entry.get(tier)
+
+
+def _cache_put(key, tier: str, result: Dict[str, Any]):
+    if key is None:
+        return
+    with _cache_lock:
+        entry = _verification_cache.setdefault(key, {})
+        entry[tier] = result
+        _verification_cache.move_to_end(key)
+        while len(_verification_cache) > VERIFY_CACHE_MAX_ENTRIES:
+            _verification_cache.popitem(last=False)
+
+
+def _read_tail(file_path: str, file_size: int) -> bytes:
+    with open(file_path, "rb") as f:
+        f.seek(max(0, file_size - TAIL_WINDOW))
+        return f.read()
+
+
+def _check_tiff_extents(file_path: str, file_size: int) -> Dict[str, Any]:
+    """Compare the furthest strip/tile byte the IFD points at with the actual file size"""
+    with Image.open(file_path) as img:
+        tags = getattr(img, "tag_v2", None)
+        if not tags:
+            return {"status": "unchecked", "detail": "No TIFF tags available"}
+
+        offsets = tags.get(TIFF_STRIP_OFFSETS) or tags.get(TIFF_TILE_OFFSETS)
+        counts = tags.get(TIFF_STRIP_BYTE_COUNTS) or tags.get(TIFF_TILE_BYTE_COUNTS)
+        if not offsets or not counts:
+            return {"status": "unchecked", "detail": "No strip or tile offsets in IFD"}
+
+        if not isinstance(offsets, (list, tuple)):
+            offsets = (offsets,)
+        if not isinstance(counts, (list, tuple)):
+            counts = (counts,)
+
+        expected_end = max(int(o) + int(c) for o, c in zip(offsets, counts))
+        if expected_end > file_size:
+            return {
+                "status": "truncated",
+                "detail": f"Image data extends to byte {expected_end} but file has {file_size} bytes",
+            }
+        return {"status": "ok", "detail": "Strip/tile extents within file"}
+
+
+def quick_check(file_path: str) -> Dict[str, Any]:
+    """
+    Cheap structural check for truncated or half-copied files.
+    Reads at most the IFD (TIFF) or the last TAIL_WINDOW bytes (JPEG/PNG), never decodes pixels.
+    """
+    key = _cache_key(file_path)
+    cached = _cache_get(key, "quick")
+    if cached is not None:
+        return cached
+
+    extension = os.path.splitext(file_path)[-1].lower()
+    try:
+        file_size = os.path.getsize(file_path)
+        if file_size == 0:
+            result = {"status": "truncated", "detail": "File is empty"}
+        elif extension in TIFF_EXTENSIONS:
+            result = _check_tiff_extents(file_path, file_size)
+        elif extension in JPEG_EXTENSIONS:
+            if JPEG_EOI in _read_tail(file_path, file_size):
+                result = {"status": "ok", "detail": "JPEG EOI marker present"}
+            else:
+                result = {"status": "truncated", "detail": "JPEG EOI marker missing"}
+        elif extension in PNG_EXTENSIONS:
+            if PNG_IEND in _read_tail(file_path, file_size):
+                result = {"status": "ok", "detail": "PNG IEND chunk present"}
+            else:
+                result = {"status": "truncated", "detail": "PNG IEND chunk missing"}
+        else:
+            result = {"status": "unchecked", "detail": f"No quick check for {extension} files"}
+    except Exception as e:
+        result = {"status": "corrupt", "detail": f"Quick check failed: {str(e)}"}
+
+    result["tier"] = "quick"
+    _cache_put(key, "quick", result)
+    return result
+
+
+def full_decode_check(file_path: str) -> Dict[str, Any]:
+    """Fully decode the image. Runs in a worker process, so it must stay a top-level function."""
+    try:
+        with Image.open(file_path) as img:
+            img.load()
+        return {"status": "ok", "detail": "Full decode succeeded", "tier": "decode"}
+    except Exception as e:
+        return {"status": "corrupt", "detail": f"Full decode failed: {str(e)}", "tier": "decode"}
+
+
+def check_verify_options(level: str, sample_fraction: float = 0.0, time_budget_seconds: Optional[float] = None):
+    """Raise ValueError for a verification request that cannot do what it asks for"""
+    if level not in VERIFY_LEVELS:
+        raise ValueError(f"Invalid verify level '{level}', expected one of {VERIFY_LEVELS}")
+    if level == "sampled" and not (sample_fraction and sample_fraction > 0) and not time_budget_seconds:
+        raise ValueError("verify=sampled needs a sample_fraction above 0 or a time_budget_seconds")
+
+
+def _collect_file_records(folder_data: Dict[str, Any]) -> List[Tuple[str, Dict[str, Any]]]:
+    """Flatten a folder structure into (file_path, file_record) pairs"""
+    records = []
+    for file_info in folder_data.get("files", []):
+        records.append((os.path.join(folder_data["path"], file_info["name"]), file_info))
+    for subfolder in folder_data.get("subfolders", []):
+        records.extend(_collect_file_records(subfolder))
+    return records
+
+
+def verify_folder_structure(
+    folder_data: Dict[str, Any],
+    level: str = "none",
+    sample_fraction: float = 0.0,
+    time_budget_seconds: Optional[float] = None,
+) -> Dict[str, Any]:
+    """
+    Attach an "integrity" result to every file record of a deck's folder structure
+    and a "verification" summary to the deck root.
+
+    For the sampled level, sample_fraction selects how many leaves of the deck get a full
+    decode and time_budget_seconds caps how long we wait for them. With only a time budget,
+    every leaf is a candidate and we decode as many as fit. Leaves that already have a cached
+    decode result count towards the sample and are never decoded again.
+    """
+    check_verify_options(level, sample_fraction, time_budget_seconds)
+    if level == "none" or not folder_data:
+        return folder_data
+
+    records = _collect_file_records(folder_data)
+    summary = {"level": level, "checked": 0, "decoded": 0, "failed": 0, "budget_exhausted": False}
+
+    # Quick tier on everything
+    decode_candidates = []
+    for file_path, file_info in records:
+        result = quick_check(file_path)
+        file_info["integrity"] = result
+        summary["checked"] += 1
+
+        if result["status"] in ("truncated", "corrupt"):
+            continue  # No point spending decode budget on a file we already know is broken
+        cached = _cache_get(_cache_key(file_path), "decode")
+        if cached is not None:
+            file_info["integrity"] = cached
+            summary["decoded"] += 1
+        else:
+            decode_candidates.append((file_path, file_info))
+
+    if level == "sampled":
+        if sample_fraction and sample_fraction > 0:
+            target = math.ceil(len(records) * min(sample_fraction, 1.0))
+            remaining = max(0, target - summary["decoded"])
+        else:  # Only a time budget (check_verify_options rejects neither)
+            remaining = len(decode_candidates)
+
+        random.shuffle(decode_candidates)  # Spread coverage across the whole deck
+        sample = decode_candidates[:remaining]
+        if sample:
+            summary["budget_exhausted"] = _decode_sample(sample, time_budget_seconds, summary)
+
+    summary["failed"] = sum(
+        1 for _, file_info in records
+        if file_info["integrity"]["status"] in ("truncated", "corrupt")
+    )
+    print(f"[DEBUG] Verification of {folder_data.get('path')}: {summary}")
+    folder_data["verification"] = summary
+    return folder_data
+
+
+def _decode_sample(sample, time_budget_seconds: Optional[float], summary: Dict[str, Any]) -> bool:
+    """Fully decode the sampled files in the process pool. Returns True if the budget ran out."""
+    pool = _get_pool()
+    deadline = time.monotonic() + time_budget_seconds if time_budget_seconds else None
+    pending = {pool.submit(full_decode_check, file_path): (file_path, file_info) for file_path, file_info in sample}
+
+    while pending:
+        timeout = None
+        if deadline is not None:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+        done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            file_path, file_info = pending.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {"status": "corrupt", "detail": f"Decode worker failed: {str(e)}", "tier": "decode"}
+            _cache_put(_cache_key(file_path), "decode", result)
+            file_info["integrity"] = result
+            summary["decoded"] += 1
+
+    for future in pending:
+        future.cancel()
+    return bool(pending)